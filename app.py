@@ -1,14 +1,32 @@
 import streamlit as st
 from markitdown import MarkItDown 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import mimetypes
 import os
-import tempfile
+import io
+import base64
 import json
-from datetime import datetime
-from typing import Dict, List, Tuple, Optional, Any
-from pathlib import Path
+import re
+import csv
+import html2text
+from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+import hashlib
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, TypeVar, List, Tuple, Optional, Any
 import logging
+import numpy as np
+from PIL import Image, ImageOps
+import tiktoken
 from dotenv import load_dotenv
 
 # Set up logging
@@ -27,16 +45,82 @@ class Config:
     OPENAI_API_KEY: str = os.getenv('OPENAI_API_KEY', '')
     DEBUG: bool = os.getenv('DEBUG', 'False').lower() == 'true'
     MAX_FILE_SIZE: int = int(os.getenv('MAX_FILE_SIZE', '10')) * 1024 * 1024  # MB to bytes
-    MODEL_NAME: str = "gpt-4"
+    MODEL_NAME: str = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')  # summarization
+    VISION_MODEL: str = os.getenv('OPENAI_VISION_MODEL', 'gpt-4o')  # image description
+    SUMMARY_MAX_TOKENS: int = 400
+    MIN_SUMMARY_CHARS: int = 200  # shorter texts are their own summary
+    MAX_SUMMARY_INPUT_TOKENS: int = 12000  # longer texts are map-reduce summarized
+    SUMMARY_CHUNK_CHARS: int = 16000  # ~4k tokens per map-reduce section
+    MAX_CONDENSE_PASSES: int = 4  # each pass shrinks the text roughly tenfold
+    MAX_CONCURRENT_REQUESTS: int = 4
+    MAX_WORKERS: int = 8  # shared threads for blocking conversion work
+    SUMMARY_CACHE_SIZE: int = 256
+    SUMMARY_CACHE_TTL: int = 86400  # seconds
+    EMBEDDING_MODEL: str = "text-embedding-3-small"
+    SEMANTIC_CACHE_THRESHOLD: float = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.95'))
+    SEMANTIC_CACHE_SIZE: int = 512
+    SEMANTIC_CACHE_MAX_CHARS: int = 8000  # longer texts aren't fully captured by one embedding
+    IMAGE_MAX_DIMENSION: int = 1024  # vision models downsample larger images anyway
+    IMAGE_COMPRESS_MIN_BYTES: int = 200_000  # smaller images are sent as is
+    HISTORY_DB: str = os.getenv('HISTORY_DB', 'history.db')
+    HISTORY_LIMIT: int = 10  # items shown in the sidebar
+    HISTORY_CONTENT_CHARS: int = 100_000  # stored content is truncated past this
+    HISTORY_MAX_ITEMS: int = 50  # per owner; older entries are deleted
+    HISTORY_MAX_AGE_DAYS: int = int(os.getenv('HISTORY_MAX_AGE_DAYS', '30'))
 
 # Validate configuration
 if not Config.OPENAI_API_KEY:
     st.error("⚠️ OpenAI API key not found. Please set the OPENAI_API_KEY environment variable.")
     st.stop()
 
+@st.cache_resource
+def get_openai_client() -> OpenAI:
+    """Return the process-wide OpenAI client."""
+    return OpenAI()
+
+@st.cache_resource
+def get_markitdown(_client: OpenAI) -> MarkItDown:
+    """
+    Return the process-wide MarkItDown converter.
+    
+    Images embedded in documents are described with Config.VISION_MODEL.
+    
+    Args:
+        _client: OpenAI client instance (not part of the cache key)
+        
+    Returns:
+        MarkItDown: Shared converter instance
+    """
+    return MarkItDown(mlm_client=_client, mlm_model=Config.VISION_MODEL)
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Return the process-wide thread pool for blocking work."""
+    return ThreadPoolExecutor(max_workers=Config.MAX_WORKERS, thread_name_prefix="file-analyzer")
+
+T = TypeVar("T")
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run a blocking call on the shared thread pool without blocking the event loop.
+    
+    Unlike asyncio.to_thread, this reuses threads across reruns: each
+    asyncio.run creates and tears down its own default executor.
+    
+    Args:
+        func: Blocking callable
+        *args: Positional arguments for func
+        **kwargs: Keyword arguments for func
+        
+    Returns:
+        The return value of func
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
 # Initialize OpenAI client
 try:
-    client = OpenAI()
+    client = get_openai_client()
 except Exception as e:
     logger.error(f"Failed to initialize OpenAI client: {e}")
     st.error("Failed to initialize AI services. Please check your configuration.")
@@ -46,9 +130,20 @@ except Exception as e:
 FileInfo = Dict[str, Dict[str, str]]
 HistoryItem = Dict[str, Any]
 
-# Initialize session state for history
-if 'conversion_history' not in st.session_state:
-    st.session_state.conversion_history: List[HistoryItem] = []
+def new_semantic_cache() -> Dict[str, Any]:
+    """
+    Create an empty semantic cache.
+    
+    Embeddings live in a ring buffer ('embs'), grown on demand up to
+    Config.SEMANTIC_CACHE_SIZE rows, with a parallel
+    list of (summary, text_sha, model) entries; 'next' counts insertions so the
+    oldest slot is overwritten in O(1) once the cache is full.
+    """
+    return {'embs': None, 'entries': [], 'next': 0}
+
+# Initialize session state for the semantic summary cache
+if 'sem_cache' not in st.session_state:
+    st.session_state.sem_cache = new_semantic_cache()
 
 # File type definitions with type hints
 FILE_TYPES: FileInfo = {
@@ -68,6 +163,142 @@ FILE_TYPES: FileInfo = {
     "zip": {"icon": "📦", "name": "ZIP Archive", "mime": "application/zip"},
 }
 
+# Precomputed views of FILE_TYPES for the per-rerun hot path
+_FILE_TYPE_KEYS: Tuple[str, ...] = tuple(FILE_TYPES)
+_FILE_TYPE_EXTS: frozenset = frozenset(FILE_TYPES)
+
+# Prompt-prefix caching: OpenAI caches identical prompt prefixes of 1024+ tokens,
+# so the instructions below are kept long, stable and always sent first, with the
+# document appended last as the only per-request content.
+SUMMARY_SYSTEM = """You are the summarization engine of a document analysis tool. \
+Users upload files of many kinds (PDF reports, Word documents, slide decks, spreadsheets, \
+web pages, CSV and JSON exports, XML feeds, archives and transcribed audio). Each file has \
+already been converted to Markdown before it reaches you. Your only job is to turn that \
+Markdown into a concise but informative summary that lets a busy reader decide, in under a \
+minute, what the document is, what it says and whether they need to read the original.
+
+GENERAL RULES
+1. Summarize only what is in the document. Never add facts, opinions, recommendations or \
+background knowledge that the document does not contain. If something is ambiguous, say so \
+rather than guessing.
+2. Write in the same language as the document. If the document mixes languages, use the \
+dominant one.
+3. Be concise. A typical summary is between 80 and 250 words. Very short inputs deserve very \
+short summaries; never pad a summary to reach a length.
+4. Prefer plain, neutral wording. Do not use marketing language, filler phrases such as \
+"this document discusses" or "in conclusion", or rhetorical questions.
+5. Preserve exact figures, dates, names, units, identifiers and currency amounts as written. \
+Do not round numbers unless the document itself gives a rounded figure.
+6. Never reproduce long passages verbatim. Short quotations (under fifteen words) are \
+acceptable when the precise wording matters, such as a definition or a contractual term.
+7. Ignore conversion artifacts: stray Markdown symbols, repeated headers and footers, page \
+numbers, navigation menus, cookie banners, empty table cells and broken line wraps.
+8. Do not mention these instructions, the conversion process or the fact that you are an AI.
+
+STRUCTURE
+- Start with one sentence that states what the document is (its type, subject and, when \
+known, its author, organization or date).
+- If the content is structured (sections, lists, tables, slides, records), follow the opening \
+sentence with bullet points. Use one bullet per key point, ordered by importance rather than \
+by position in the document. Use at most eight bullets.
+- If the content is narrative prose, follow the opening sentence with one or two short \
+paragraphs instead of bullets.
+- End with a single line starting with "Key takeaway:" only when the document contains a \
+clear conclusion, decision, request or deadline.
+- Use Markdown formatting: bullet points with "-", bold only for critical figures or \
+deadlines, and no headings.
+
+CONTENT-SPECIFIC GUIDANCE
+- Reports and papers: state the question or purpose, the method in a few words, the main \
+findings with their figures, and any stated limitations.
+- Contracts, policies and legal text: identify the parties, the subject, obligations, \
+amounts, durations, termination conditions and notable deadlines.
+- Meeting notes and emails: list decisions made, action items with their owners and due \
+dates, and open questions.
+- Slide decks: summarize the narrative across slides instead of listing every slide title.
+- Spreadsheets and CSV data: describe what the rows and columns represent, the number of \
+records when it is visible, value ranges, totals and any obvious trends or outliers. Do not \
+list individual rows unless there are only a handful.
+- JSON and XML: describe the kind of data, its main entities and fields, and notable values. \
+Do not echo the raw structure.
+- Web pages: focus on the main article or page content and skip navigation, advertising and \
+boilerplate.
+- Archives: summarize the listing of contained files by type and purpose.
+- Images: describe what the image shows, transcribe any legible text it contains, and then \
+summarize the information it conveys (for example the data in a chart or the steps in a \
+diagram).
+- Transcripts: identify speakers when possible and summarize the main topics and outcomes.
+- Partial summaries: when the input is a set of section summaries of one long document, \
+merge them into a single coherent summary, remove repetition and keep the most important \
+points from every section.
+
+QUALITY CHECKLIST (apply silently before answering)
+- Would a reader who never opens the original know what it is about and what matters most?
+- Is every statement supported by the document?
+- Are all numbers, names and dates copied exactly?
+- Is there any redundancy that can be removed?
+- Is the length proportional to the amount of substantive content?
+
+EXAMPLE
+Input: a two-page internal memo announcing that the Berlin office will move to a new building \
+on 1 March, listing the new address, the packing schedule for each team, and asking staff to \
+return their old access badges by 28 February.
+Output:
+Internal memo announcing the relocation of the Berlin office on 1 March.
+- The office moves to the new building listed in the memo; the old site closes the same day.
+- Each team has an assigned packing slot during the last week of February.
+- IT equipment is moved by facilities; personal items must be packed by staff.
+Key takeaway: return old access badges by **28 February**.
+
+If the document contains no meaningful content (for example only boilerplate or an empty \
+table), reply with a single sentence saying that no substantive content was found."""
+
+def _decode_text(data: bytes) -> str:
+    """Decode text file bytes as UTF-8, dropping a leading byte order mark."""
+    return data.decode("utf-8-sig")
+
+def _bytes_to_md_csv(data: bytes) -> str:
+    """Render CSV bytes as a Markdown table with the first row as header."""
+    rows = list(csv.reader(io.StringIO(_decode_text(data))))
+    if not rows:
+        return ""
+    width = max(len(row) for row in rows)
+
+    def line(cells: List[str]) -> str:
+        cells = cells + [""] * (width - len(cells))
+        return "| " + " | ".join(c.replace("|", "\\|").replace("\n", " ") for c in cells) + " |"
+
+    return "\n".join([line(rows[0]), line(["---"] * width)] + [line(row) for row in rows[1:]])
+
+def _pretty_json(data: bytes) -> str:
+    """Pretty-print JSON bytes as a fenced Markdown code block."""
+    return f"```json\n{json.dumps(json.loads(_decode_text(data)), indent=2, ensure_ascii=False)}\n```"
+
+def _pretty_xml(data: bytes) -> str:
+    """Pretty-print XML bytes as a fenced Markdown code block."""
+    pretty = minidom.parseString(data).toprettyxml(indent="  ")
+    lines = [line for line in pretty.splitlines() if line.strip()]
+    return "```xml\n" + "\n".join(lines) + "\n```"
+
+def _html_to_md(data: bytes) -> str:
+    """Convert HTML bytes to Markdown with html2text."""
+    converter = html2text.HTML2Text()
+    converter.body_width = 0  # don't hard-wrap lines
+    return converter.handle(data.decode("utf-8", errors="replace"))
+
+# Text formats decoded directly instead of through the MarkItDown pipeline
+FAST_DECODERS: Dict[str, Callable[[bytes], str]] = {
+    "csv": _bytes_to_md_csv,
+    "json": _pretty_json,
+    "xml": _pretty_xml,
+    "html": _html_to_md,
+}
+
+def _ext(name: str) -> str:
+    """Return the lowercased extension of a file name, without the dot."""
+    i = name.rfind(".")
+    return name[i + 1:].lower() if i >= 0 else ""
+
 def validate_file(file: Any) -> Tuple[bool, str]:
     """
     Validate the uploaded file.
@@ -81,94 +312,736 @@ def validate_file(file: Any) -> Tuple[bool, str]:
     if file.size > Config.MAX_FILE_SIZE:
         return False, f"File size exceeds {Config.MAX_FILE_SIZE // (1024*1024)}MB limit"
     
-    file_ext = Path(file.name).suffix[1:].lower()
-    if file_ext not in FILE_TYPES:
+    file_ext = _ext(file.name)
+    if file_ext not in _FILE_TYPE_EXTS:
         return False, f"Unsupported file type: {file_ext}"
     
     return True, ""
 
-def generate_smart_summary(text: str, client: OpenAI) -> str:
+class SummaryCache:
+    """Thread-safe LRU of summaries keyed by (model, text_sha), shared by all sessions."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items: "OrderedDict[Tuple[str, str], Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str]) -> Optional[str]:
+        """Return the cached summary for key, or None if missing or expired."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            stored_at, summary = item
+            if time.time() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return summary
+
+    def put(self, key: Tuple[str, str], summary: str) -> None:
+        """Store a summary, evicting the least recently used entries past the cap."""
+        with self._lock:
+            self._items[key] = (time.time(), summary)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+@st.cache_resource
+def get_summary_cache() -> SummaryCache:
+    """Return the process-wide exact-match summary cache."""
+    return SummaryCache(Config.SUMMARY_CACHE_SIZE, Config.SUMMARY_CACHE_TTL)
+
+async def _embed(text: str, aclient: AsyncOpenAI) -> np.ndarray:
     """
-    Generate an AI-powered summary of the text content.
+    Embed the text and L2-normalize the result.
     
     Args:
-        text: The text to summarize
-        client: OpenAI client instance
+        text: The text to embed
+        aclient: Async OpenAI client instance
         
     Returns:
-        str: Generated summary
+        np.ndarray: Unit-length float32 embedding
+    """
+    response = await aclient.embeddings.create(model=Config.EMBEDDING_MODEL, input=text)
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else embedding
+
+def _semantic_lookup(embedding: np.ndarray, model: str) -> Optional[str]:
+    """
+    Return the cached summary of the nearest previously summarized text.
+    
+    Args:
+        embedding: Unit-length embedding of the text to summarize
+        model: Chat model the summary must come from
+        
+    Returns:
+        Optional[str]: Cached summary if its cosine similarity reaches the threshold
+    """
+    cache = st.session_state.sem_cache
+    entries = cache['entries']
+    if not entries:
+        return None
+    scores = cache['embs'][:len(entries)] @ embedding
+    same_model = np.fromiter((entry[2] == model for entry in entries), dtype=bool, count=len(entries))
+    scores = np.where(same_model, scores, -np.inf)
+    best = int(np.argmax(scores))
+    if scores[best] >= Config.SEMANTIC_CACHE_THRESHOLD:
+        return cache['entries'][best][0]
+    return None
+
+def _semantic_store(embedding: np.ndarray, summary: str, text_sha: str, model: str) -> None:
+    """
+    Add a summary to the semantic cache, overwriting the oldest entry when full.
+    
+    Args:
+        embedding: Unit-length embedding of the summarized text
+        summary: Generated summary
+        text_sha: SHA-256 hex digest of the summarized text
+        model: Chat model that produced the summary
+    """
+    cache = st.session_state.sem_cache
+    slot = cache['next'] % Config.SEMANTIC_CACHE_SIZE
+    embs = cache['embs']
+    if embs is None or slot >= embs.shape[0]:
+        # Grow by doubling up to the cap instead of reserving it all up front
+        rows = min(max(16, 2 * slot), Config.SEMANTIC_CACHE_SIZE)
+        grown = np.zeros((rows, embedding.shape[0]), dtype=np.float32)
+        if embs is not None:
+            grown[:embs.shape[0]] = embs
+        cache['embs'] = grown
+    cache['embs'][slot] = embedding
+    if slot < len(cache['entries']):
+        cache['entries'][slot] = (summary, text_sha, model)
+    else:
+        cache['entries'].append((summary, text_sha, model))
+    cache['next'] += 1
+
+@st.cache_resource
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """Return the tokenizer for a model, falling back to o200k_base, or None if it can't be loaded."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # tiktoken downloads encodings on first use, which fails offline
+        logger.warning(f"Tokenizer unavailable, estimating token counts: {e}")
+        return None
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Count the tokens a text uses for the given model.
+    
+    Falls back to a four-characters-per-token estimate when the tokenizer
+    can't be loaded.
+    
+    Args:
+        text: The text to count
+        model: Model whose tokenizer is used
+        
+    Returns:
+        int: Number of tokens
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def split_into_chunks(text: str, max_chars: int) -> List[str]:
+    """
+    Split text on paragraph boundaries into chunks of at most max_chars.
+    
+    Paragraphs longer than max_chars are hard-split.
+    
+    Args:
+        text: The text to split
+        max_chars: Maximum characters per chunk
+        
+    Returns:
+        List[str]: Chunks in document order
+    """
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for paragraph in text.split("\n\n"):
+        if current and size + len(paragraph) + 2 > max_chars:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+        while len(paragraph) > max_chars:
+            chunks.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        current.append(paragraph)
+        size += len(paragraph) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+async def _summarize_chunk(chunk: str, index: int, total: int, aclient: AsyncOpenAI,
+                           semaphore: asyncio.Semaphore) -> str:
+    """
+    Summarize one section of a long document (the map step).
+    
+    Args:
+        chunk: Section text
+        index: 1-based section number
+        total: Total number of sections
+        aclient: Async OpenAI client instance
+        semaphore: Limits concurrent requests
+        
+    Returns:
+        str: Section summary
+    """
+    async with semaphore:
+        response = await aclient.chat.completions.create(
+            model=Config.MODEL_NAME,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM},
+                {"role": "user", "content": f"Section {index} of {total} of a longer document. "
+                                            f"Summarize it in at most 200 words.\n\n{chunk}"}
+            ],
+            max_tokens=Config.SUMMARY_MAX_TOKENS,
+            temperature=0
+        )
+    return response.choices[0].message.content or ""
+
+async def summarize_chunks(chunks: List[str], aclient: AsyncOpenAI) -> List[str]:
+    """
+    Summarize document sections concurrently.
+    
+    Args:
+        chunks: Section texts in document order
+        aclient: Async OpenAI client instance
+        
+    Returns:
+        List[str]: Section summaries in document order
+    """
+    semaphore = asyncio.Semaphore(Config.MAX_CONCURRENT_REQUESTS)
+    return await asyncio.gather(*(
+        _summarize_chunk(chunk, i, len(chunks), aclient, semaphore)
+        for i, chunk in enumerate(chunks, start=1)
+    ))
+
+async def condense_text(text: str, aclient: AsyncOpenAI) -> str:
+    """
+    Reduce a text until it fits in a single summary prompt.
+    
+    Each pass splits the text into sections and summarizes them in parallel;
+    passes repeat on the joined section summaries while they are still over
+    Config.MAX_SUMMARY_INPUT_TOKENS, up to Config.MAX_CONDENSE_PASSES times.
+    
+    Args:
+        text: The text to condense
+        aclient: Async OpenAI client instance
+        
+    Returns:
+        str: The text itself, or summaries of its consecutive sections
+        
+    Raises:
+        Exception: If a pass does not shrink the text or it still does not fit
+            after the last pass
+    """
+    tokens = await run_blocking(count_tokens, text, Config.MODEL_NAME)
+    for _ in range(Config.MAX_CONDENSE_PASSES):
+        if tokens <= Config.MAX_SUMMARY_INPUT_TOKENS:
+            return text
+        chunks = split_into_chunks(text, Config.SUMMARY_CHUNK_CHARS)
+        logger.info(f"Condensing {len(chunks)} sections ({tokens} tokens)")
+        partials = await summarize_chunks(chunks, aclient)
+        text = "Summaries of consecutive sections of one document:\n\n" + "\n\n".join(partials)
+        condensed = await run_blocking(count_tokens, text, Config.MODEL_NAME)
+        if condensed >= tokens:
+            raise Exception(f"Condensing did not shrink the text ({tokens} -> {condensed} tokens)")
+        tokens = condensed
+    if tokens > Config.MAX_SUMMARY_INPUT_TOKENS:
+        raise Exception(f"Text still has {tokens} tokens after {Config.MAX_CONDENSE_PASSES} condensing passes")
+    return text
+
+def _log_prompt_cache(usage: Any) -> None:
+    """
+    Log how many prompt tokens were served from the provider's prefix cache.
+    
+    Args:
+        usage: Usage block from the final streamed chunk
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    logger.info(f"Summary prompt tokens: {usage.prompt_tokens} ({cached_tokens} cached)")
+
+async def generate_smart_summary(text: str, aclient: AsyncOpenAI) -> AsyncIterator[str]:
+    """
+    Stream an AI-powered summary of the text content.
+    
+    Identical texts are served from the summary cache without an API call, and
+    near-duplicates of up to Config.SEMANTIC_CACHE_MAX_CHARS are matched against
+    earlier summaries by embedding similarity.
+    Cache hits are yielded as a single chunk. Texts shorter than
+    Config.MIN_SUMMARY_CHARS are returned as is, and texts over
+    Config.MAX_SUMMARY_INPUT_TOKENS are summarized map-reduce style: sections
+    in parallel, repeated until the partials fit, then a streamed final pass.
+    
+    Args:
+        text: The text to summarize
+        aclient: Async OpenAI client instance
+        
+    Yields:
+        str: Summary text fragments as they are generated
         
     Raises:
         Exception: If summary generation fails
     """
+    # Too short to be worth an API call
+    if len(text) < Config.MIN_SUMMARY_CHARS:
+        yield text
+        return
+
     try:
-        response = client.chat.completions.create(
+        text_sha = hashlib.sha256(text.encode()).hexdigest()
+        cache_key = (Config.MODEL_NAME, text_sha)
+        summary_cache = get_summary_cache()
+
+        cached = summary_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        # Near-duplicate matching only for texts a single embedding fully covers
+        embedding = None
+        if len(text) <= Config.SEMANTIC_CACHE_MAX_CHARS:
+            try:
+                embedding = await _embed(text, aclient)
+                cached = _semantic_lookup(embedding, Config.MODEL_NAME)
+            except Exception as e:
+                logger.warning(f"Semantic cache unavailable: {e}")
+        if cached is not None:
+            yield cached
+            return
+
+        prompt_text = await condense_text(text, aclient)
+
+        stream = await aclient.chat.completions.create(
             model=Config.MODEL_NAME,
             messages=[
-                {"role": "system", "content": "Create a concise but informative summary of the following content. Use bullet points if the content is structured."},
-                {"role": "user", "content": text}
-            ]
+                {"role": "system", "content": SUMMARY_SYSTEM},
+                {"role": "user", "content": prompt_text}
+            ],
+            max_tokens=Config.SUMMARY_MAX_TOKENS,
+            temperature=0,
+            stream=True,
+            stream_options={"include_usage": True}
         )
-        return response.choices[0].message.content
+        parts = []
+        async for chunk in stream:
+            if chunk.usage is not None:
+                _log_prompt_cache(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            parts.append(delta)
+            yield delta
+
+        summary = "".join(parts)
+        summary_cache.put(cache_key, summary)
+        if embedding is not None:
+            _semantic_store(embedding, summary, text_sha, Config.MODEL_NAME)
     except Exception as e:
         logger.error(f"Error generating summary: {e}")
         raise Exception(f"Failed to generate summary: {str(e)}")
 
-def save_to_history(filename: str, summary: str, content: str) -> None:
+async def write_stream(chunks: AsyncIterator[str]) -> str:
     """
-    Save conversion result to history.
+    Render streamed text into a placeholder as it arrives.
     
     Args:
+        chunks: Text fragments
+        
+    Returns:
+        str: The full text
+    """
+    placeholder = st.empty()
+    text = ""
+    async for chunk in chunks:
+        text += chunk
+        placeholder.markdown(text)
+    return text
+
+def history_owner_token() -> str:
+    """
+    Return the visitor's history owner token, issuing one if the URL has none.
+    
+    The token lives in the `history` query parameter, so reloading or
+    bookmarking the page reopens the same history while other visitors, who
+    get their own token, never see it.
+    
+    Returns:
+        str: 32-character hex owner token
+    """
+    token = st.query_params.get("history", "")
+    if not re.fullmatch(r"[0-9a-f]{32}", token):
+        token = uuid.uuid4().hex
+        st.query_params["history"] = token
+    return token
+
+@st.cache_resource
+def init_history_db(path: str) -> str:
+    """
+    Create the history schema once per process and enable WAL journaling.
+    
+    Args:
+        path: SQLite database file
+        
+    Returns:
+        str: The database path
+    """
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conversions (
+                owner TEXT,
+                sha TEXT,
+                filename TEXT,
+                summary TEXT,
+                content TEXT,
+                ts TEXT,
+                PRIMARY KEY (owner, sha)
+            );
+            CREATE TABLE IF NOT EXISTS conversions_order (owner TEXT, ts TEXT, sha TEXT);
+            CREATE INDEX IF NOT EXISTS conversions_order_owner_ts ON conversions_order (owner, ts);
+            CREATE INDEX IF NOT EXISTS conversions_order_owner_sha ON conversions_order (owner, sha);
+        """)
+    return path
+
+def _history_connection() -> sqlite3.Connection:
+    """Open a connection to the history database, creating it if needed."""
+    return sqlite3.connect(init_history_db(Config.HISTORY_DB), timeout=10)
+
+def _prune_history(conn: sqlite3.Connection, owner: str) -> None:
+    """
+    Delete entries past the retention limits, then content no entry refers to.
+    
+    Args:
+        conn: Open history connection, inside the caller's transaction
+        owner: Owner whose entries are capped at Config.HISTORY_MAX_ITEMS
+    """
+    cutoff = (datetime.now() - timedelta(days=Config.HISTORY_MAX_AGE_DAYS)).isoformat()
+    conn.execute("DELETE FROM conversions_order WHERE ts < ?", (cutoff,))
+    conn.execute("""
+        DELETE FROM conversions_order
+        WHERE owner = ? AND rowid NOT IN (
+            SELECT rowid FROM conversions_order WHERE owner = ? ORDER BY ts DESC LIMIT ?
+        )
+    """, (owner, owner, Config.HISTORY_MAX_ITEMS))
+    conn.execute("""
+        DELETE FROM conversions
+        WHERE NOT EXISTS (
+            SELECT 1 FROM conversions_order o
+            WHERE o.owner = conversions.owner AND o.sha = conversions.sha
+        )
+    """)
+
+def save_to_history(owner: str, filename: str, summary: str, content: str) -> None:
+    """
+    Save conversion result to the owner's history.
+    
+    Results are keyed by owner and the SHA-256 of their content, so re-uploads
+    of the same file add an order row but no duplicate content. Content past
+    Config.HISTORY_CONTENT_CHARS is truncated, and entries older than
+    Config.HISTORY_MAX_AGE_DAYS or beyond the owner's newest
+    Config.HISTORY_MAX_ITEMS are deleted.
+    
+    Args:
+        owner: Owner token of the visitor that produced the result
         filename: Name of the processed file
         summary: Generated summary
         content: Full content
     """
-    history_item = {
-        'timestamp': datetime.now().isoformat(),
-        'filename': filename,
-        'summary': summary,
-        'content': content
-    }
-    st.session_state.conversion_history.insert(0, history_item)
-    # Keep only last 10 items
-    st.session_state.conversion_history = st.session_state.conversion_history[:10]
+    sha = hashlib.sha256(content.encode()).hexdigest()
+    timestamp = datetime.now().isoformat()
+    with closing(_history_connection()) as conn, conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO conversions (owner, sha, filename, summary, content, ts) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (owner, sha, filename, summary, content[:Config.HISTORY_CONTENT_CHARS], timestamp)
+        )
+        conn.execute(
+            "INSERT INTO conversions_order (owner, ts, sha) VALUES (?, ?, ?)", (owner, timestamp, sha)
+        )
+        _prune_history(conn, owner)
+    load_history.clear()
 
-def process_image(image_path: str, client: OpenAI) -> Tuple[str, bytes]:
+@st.cache_data(ttl=5)
+def load_history(owner: str, limit: int) -> List[HistoryItem]:
     """
-    Process image and return description and image data.
+    Load the owner's most recently converted items, newest first.
     
     Args:
-        image_path: Path to the image file
+        owner: Owner whose history is loaded
+        limit: Maximum number of items
+        
+    Returns:
+        List[HistoryItem]: History items with timestamp, filename and summary
+    """
+    with closing(_history_connection()) as conn:
+        rows = conn.execute("""
+            SELECT MAX(o.ts), c.filename, c.summary
+            FROM conversions_order o
+            JOIN conversions c ON c.owner = o.owner AND c.sha = o.sha
+            WHERE o.owner = ?
+            GROUP BY c.sha
+            ORDER BY MAX(o.ts) DESC
+            LIMIT ?
+        """, (owner, limit)).fetchall()
+    return [
+        {'timestamp': ts, 'filename': filename, 'summary': summary}
+        for ts, filename, summary in rows
+    ]
+
+async def extract_text(data: bytes, file_ext: str, client: OpenAI) -> str:
+    """
+    Extract Markdown text from a non-image upload.
+    
+    Formats in FAST_DECODERS are decoded directly; everything else, and any
+    file a fast decoder cannot parse, goes through MarkItDown.
+    
+    Args:
+        data: Raw file bytes
+        file_ext: File extension without the dot
         client: OpenAI client instance
         
     Returns:
-        Tuple[str, bytes]: (description, image_data)
+        str: Extracted text
+    """
+    decoder = FAST_DECODERS.get(file_ext)
+    if decoder is not None:
+        try:
+            return await run_blocking(decoder, data)
+        except (ValueError, csv.Error, ExpatError) as e:
+            logger.warning(f"Fast {file_ext} decoding failed, falling back to MarkItDown: {e}")
+
+    markitdown = get_markitdown(client)
+    # MarkItDown is synchronous; keep it off the event loop
+    result = await run_blocking(
+        markitdown.convert_stream, io.BytesIO(data), file_extension=f".{file_ext}"
+    )
+    return result.text_content or ""
+
+def compress_image(image_bytes: bytes, mime: str) -> Tuple[bytes, str]:
+    """
+    Downscale and re-encode a large image as JPEG before sending it to the model.
+    
+    EXIF orientation is applied to the pixels, since it is not carried over, and
+    transparent areas are flattened onto white.
+    Images under Config.IMAGE_COMPRESS_MIN_BYTES, that cannot be decoded, or
+    that would not get smaller are returned unchanged.
+    
+    Args:
+        image_bytes: Raw image bytes
+        mime: MIME type of the raw image
+        
+    Returns:
+        Tuple[bytes, str]: (image_bytes, mime) to send
+    """
+    if len(image_bytes) < Config.IMAGE_COMPRESS_MIN_BYTES:
+        return image_bytes, mime
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+            # JPEG has no alpha channel; dropping it would expose the stored
+            # colour of transparent pixels, which is usually black
+            img = Image.alpha_composite(Image.new("RGBA", img.size, "white"), img.convert("RGBA"))
+        img.thumbnail((Config.IMAGE_MAX_DIMENSION, Config.IMAGE_MAX_DIMENSION), Image.Resampling.LANCZOS)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85, optimize=True)
+    except OSError as e:
+        logger.warning(f"Image compression skipped: {e}")
+        return image_bytes, mime
+    if buf.tell() >= len(image_bytes):
+        return image_bytes, mime
+    return buf.getvalue(), "image/jpeg"
+
+async def process_image(image_bytes: bytes, file_ext: str, aclient: AsyncOpenAI) -> AsyncIterator[str]:
+    """
+    Stream a description and summary of an image from a single vision call.
+    
+    Large images are downscaled first; the caller keeps the original for display.
+    
+    Args:
+        image_bytes: Raw bytes of the uploaded image
+        file_ext: Image file extension without the dot
+        aclient: Async OpenAI client instance
+        
+    Yields:
+        str: Description text fragments as they are generated
         
     Raises:
         Exception: If image processing fails
     """
     try:
-        # Read image for display
-        with open(image_path, "rb") as image_file:
-            image_data = image_file.read()
-            
-        # Create markdown instance with OpenAI
-        markitdown = MarkItDown(mlm_client=client, mlm_model=Config.MODEL_NAME)
-        result = markitdown.convert(image_path)
-        
-        return result.text_content or "No description available.", image_data
+        image_bytes, mime = await run_blocking(
+            compress_image, image_bytes, FILE_TYPES[file_ext]['mime']
+        )
+        image_b64 = base64.b64encode(image_bytes).decode()
+        image_url = f"data:{mime};base64,{image_b64}"
+        stream = await aclient.chat.completions.create(
+            model=Config.VISION_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM},
+                {"role": "user", "content": [
+                    {"type": "text", "text": "Describe and summarize this image."},
+                    {"type": "image_url", "image_url": {"url": image_url}}
+                ]}
+            ],
+            max_tokens=Config.SUMMARY_MAX_TOKENS,
+            temperature=0,
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
     except Exception as e:
         logger.error(f"Error processing image: {e}")
         raise Exception(f"Image processing failed: {str(e)}")
 
-st.set_page_config(
-    page_title="LernUp File Analyzer",
-    page_icon="📄",
-    layout="centered"  # Changed to centered for better mobile view
-)
+async def handle_image(data: bytes, filename: str, file_ext: str, client: OpenAI,
+                       aclient: AsyncOpenAI, progress_bar: Any) -> Optional[Tuple[str, str]]:
+    """
+    Describe an uploaded image and render it next to the original.
+    
+    Args:
+        data: Raw file bytes
+        filename: Name of the uploaded file
+        file_ext: File extension without the dot
+        client: OpenAI client instance for document conversion
+        aclient: Async OpenAI client instance
+        progress_bar: Progress bar to advance
+        
+    Returns:
+        Optional[Tuple[str, str]]: (summary, content) to record in history, if any
+    """
+    st.info("🖼️ Analyzing image...")
+    try:
+        # Create two columns with AI Analysis first
+        col1, col2 = st.columns([3, 2])
+    
+        with col2:
+            with st.expander("📸 View Original Image", expanded=True):
+                st.image(data, caption="Uploaded Image")
+    
+        with col1:
+            st.markdown("### 🤖 AI Image Analysis")
+            # One vision call describes and summarizes; tokens render live
+            description = await write_stream(process_image(data, file_ext, aclient))
+    
+        progress_bar.progress(100)
+        st.success("✨ Analysis complete!")
+    
+        return "Image Analysis", description
+    except Exception as e:
+        st.error(f"Image analysis error: {str(e)}")
+        return None
+
+async def handle_document(data: bytes, filename: str, file_ext: str, client: OpenAI,
+                          aclient: AsyncOpenAI, progress_bar: Any) -> Optional[Tuple[str, str]]:
+    """
+    Extract text from an uploaded document, then summarize and render it.
+    
+    Args:
+        data: Raw file bytes
+        filename: Name of the uploaded file
+        file_ext: File extension without the dot
+        client: OpenAI client instance for document conversion
+        aclient: Async OpenAI client instance
+        progress_bar: Progress bar to advance
+        
+    Returns:
+        Optional[Tuple[str, str]]: (summary, content) to record in history, if any
+    """
+    text_content = (await extract_text(data, file_ext, client)).strip()
+    if not text_content:
+        st.warning("⚠️ No text content could be extracted from this file.")
+        return None
+
+    progress_bar.progress(60)
+
+    # Show summary first, then full content (removed download buttons)
+    tab1, tab2 = st.tabs(["📑 Smart Summary", "📝 Full Content"])
+    with tab1:
+        st.markdown("### AI-Generated Summary")
+        # Render tokens as they arrive; returns the full summary
+        summary = await write_stream(generate_smart_summary(text_content, aclient))
+    with tab2:
+        st.markdown("### Full Converted Content")
+        st.markdown(text_content)
+
+    progress_bar.progress(100)
+    st.success("✨ Analysis complete!")
+
+    return summary, text_content
+
+UploadHandler = Callable[[bytes, str, str, OpenAI, AsyncOpenAI, Any], Awaitable[Optional[Tuple[str, str]]]]
+
+IMAGE_TYPES = frozenset({"jpg", "jpeg", "png"})
+
+# Upload handler per supported extension; text formats take the FAST_DECODERS
+# path inside handle_document
+HANDLERS: Dict[str, UploadHandler] = {
+    ext: handle_image if ext in IMAGE_TYPES else handle_document for ext in FILE_TYPES
+}
+
+async def handle_upload(uploaded_file: Any, owner: str, client: OpenAI, aclient: AsyncOpenAI) -> None:
+    """
+    Convert, analyze and render an uploaded file.
+    
+    Args:
+        uploaded_file: The uploaded file object, already validated
+        owner: Owner token whose history records the result
+        client: OpenAI client instance
+        aclient: Async OpenAI client instance
+    """
+    file_ext = _ext(uploaded_file.name)
+
+    st.info(f"📁 {uploaded_file.name} ({uploaded_file.size / 1024:.1f} KB)")
+
+    with st.spinner("Converting and analyzing..."):
+        progress_bar = st.progress(0)
+    
+        try:
+            # Materialize the upload once and hand it to the type's handler
+            data = uploaded_file.getvalue()
+            progress_bar.progress(30)
+            record = await HANDLERS[file_ext](data, uploaded_file.name, file_ext,
+                                              client, aclient, progress_bar)
+            if record is not None:
+                summary, content = record
+                save_to_history(owner, uploaded_file.name, summary, content)
+        except Exception as e:
+            st.error(f"🚨 Error processing file: {str(e)}")
+        finally:
+            progress_bar.empty()
+
+async def main(uploaded_file: Any, owner: str, client: OpenAI) -> None:
+    """
+    Handle an upload with an AsyncOpenAI client scoped to this run.
+    
+    The client's connection pool is bound to the event loop that asyncio.run
+    creates on each rerun, so it cannot be shared across reruns.
+    
+    Args:
+        uploaded_file: The uploaded file object
+        owner: Owner token whose history records the result
+        client: Process-wide OpenAI client instance
+    """
+    async with AsyncOpenAI() as aclient:
+        await handle_upload(uploaded_file, owner, client, aclient)
 
 # Simplified CSS - remove file-type styling
-st.markdown("""
+APP_CSS = """
 <style>
     .stProgress > div > div > div > div {
         background-color: #1E90FF;
@@ -194,8 +1067,28 @@ st.markdown("""
     .history-item:hover {
         background-color: #e0e2e6;
     }
+    .file-types {
+        display: grid;
+        grid-template-columns: repeat(4, 1fr);  /* 4 columns for mobile */
+        gap: 4px;
+        margin-bottom: 1rem;
+    }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_resource
+def static_header_html() -> str:
+    """Render the page CSS and supported file types grid once per process."""
+    cells = "".join(
+        f"<div>{info['icon']} {ext}</div>" for ext, info in FILE_TYPES.items()
+    )
+    return f'{APP_CSS}<div class="file-types">{cells}</div>'
+
+st.set_page_config(
+    page_title="LernUp File Analyzer",
+    page_icon="📄",
+    layout="centered"  # Changed to centered for better mobile view
+)
 
 # Updated title section with enhanced description
 st.title("📄 File Analyzer")
@@ -213,93 +1106,35 @@ Perfect for quick document analysis and image understanding.
 
 # Updated file types display - simpler version
 st.caption("Supported file types:")
-cols = st.columns([1] * 4)  # Reduced to 4 columns for mobile
-for idx, (ext, info) in enumerate(FILE_TYPES.items()):
-    with cols[idx % 4]:
-        st.markdown(f"{info['icon']} {ext}")
+# CSS and grid never change, so they go out as one cached HTML blob
+st.markdown(static_header_html(), unsafe_allow_html=True)
+
+history_owner = history_owner_token()
+
+# Recent conversions for this history link
+with st.sidebar:
+    st.markdown("### 🕘 Recent Conversions")
+    history = load_history(history_owner, Config.HISTORY_LIMIT)
+    if not history:
+        st.caption("No conversions yet.")
+    for item in history:
+        with st.expander(item['filename']):
+            st.caption(item['timestamp'][:19].replace("T", " "))
+            st.markdown(item['summary'])
 
 # Main upload section
 uploaded_file = st.file_uploader("Choose a file", 
-                                type=list(FILE_TYPES.keys()),
+                                type=_FILE_TYPE_KEYS,
+                                accept_multiple_files=False,
                                 help="Select a file to convert to Markdown")
 
 if uploaded_file is not None:
-    file_ext = os.path.splitext(uploaded_file.name)[1][1:].lower()
-    
-    st.info(f"📁 {uploaded_file.name} ({uploaded_file.size / 1024:.1f} KB)")
-
-    with st.spinner("Converting and analyzing..."):
-        progress_bar = st.progress(0)
-        
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_ext}') as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_path = tmp_file.name
-
-            progress_bar.progress(30)
-            
-            # Handle images directly
-            if file_ext.lower() in ['jpg', 'jpeg', 'png']:
-                st.info("🖼️ Analyzing image...")
-                try:
-                    description, image_data = process_image(tmp_path, client)
-                    os.unlink(tmp_path)
-                    
-                    progress_bar.progress(100)
-                    st.success("✨ Analysis complete!")
-                    
-                    # Create two columns with AI Analysis first
-                    col1, col2 = st.columns([3, 2])
-                    
-                    with col1:
-                        st.markdown("### 🤖 AI Image Analysis")
-                        st.markdown(description)
-                    
-                    with col2:
-                        with st.expander("📸 View Original Image", expanded=True):
-                            if image_data:
-                                st.image(image_data, caption="Uploaded Image")
-                    
-                    save_to_history(uploaded_file.name, "Image Analysis", description)
-                except Exception as e:
-                    st.error(f"Image analysis error: {str(e)}")
-                    if "mlm_client" in str(e):
-                        st.info("Please check OpenAI configuration.")
-            else:
-                # Use MarkItDown for all other file types
-                markitdown = MarkItDown(mlm_client=client, mlm_model="gpt-4o")  # Fixed parameter name
-                result = markitdown.convert(tmp_path)
-
-                os.unlink(tmp_path)
-
-                text_content = (result.text_content or "").strip()
-                if text_content:
-                    progress_bar.progress(60)
-                    st.info("🤖 Generating AI-powered summary...")
-                    
-                    summary = generate_smart_summary(text_content, client)
-                    
-                    # Save to history
-                    save_to_history(uploaded_file.name, summary, text_content)
-                    
-                    progress_bar.progress(100)
-                    st.success("✨ Analysis complete!")
-                    
-                    # Show summary first, then full content (removed download buttons)
-                    tab1, tab2 = st.tabs(["📑 Smart Summary", "📝 Full Content"])
-                    with tab1:
-                        st.markdown("### AI-Generated Summary")
-                        st.markdown(summary)
-                    with tab2:
-                        st.markdown("### Full Converted Content")
-                        st.markdown(text_content)
-                else:
-                    st.warning("⚠️ No text content could be extracted from this file.")
-                
-        except Exception as e:
-            st.error(f"🚨 Error processing file: {str(e)}")
-        finally:
-            progress_bar.empty()
+    # Reject before anything copies the upload
+    is_valid, error = validate_file(uploaded_file)
+    if not is_valid:
+        st.error(f"🚨 {error}")
+        st.stop()
+    asyncio.run(main(uploaded_file, history_owner, client))
 else:
     st.markdown("""
     <div class="upload-message">
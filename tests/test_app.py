@@ -1,20 +1,64 @@
 import pytest
-from pathlib import Path
 import sys
 import os
+import tempfile
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Importing app renders the history sidebar; keep its database out of the repo
+os.environ.setdefault("HISTORY_DB", os.path.join(tempfile.mkdtemp(), "history.db"))
 
-from app import validate_file, Config, generate_smart_summary, process_image
-from unittest.mock import Mock, patch
+from app import (_ext, validate_file, Config, generate_smart_summary, process_image,
+                 split_into_chunks, summarize_chunks, condense_text, count_tokens, save_to_history, load_history,
+                 history_owner_token,
+                 extract_text, compress_image, new_semantic_cache, _semantic_lookup,
+                 _semantic_store, get_markitdown, FILE_TYPES, HANDLERS,
+                 handle_image, handle_document, SummaryCache)
+from unittest.mock import AsyncMock, Mock, patch
+import streamlit as st
 import io
+import sqlite3
+import time
+from types import SimpleNamespace
+import numpy as np
+from PIL import Image
+
+@pytest.fixture(autouse=True)
+def estimate_tokens(monkeypatch):
+    """Count tokens without tiktoken, which downloads encodings on first use."""
+    monkeypatch.setattr("app.count_tokens", lambda text, model: len(text) // 4)
 
 class MockUploadedFile:
     def __init__(self, name: str, size: int):
         self.name = name
         self.size = size
 
+class MockStream:
+    """Async iterable of streamed chat completion chunks."""
+    def __init__(self, *deltas: str):
+        self.chunks = [Mock(choices=[Mock(delta=Mock(content=delta))], usage=None) for delta in deltas]
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+def mock_aclient(*deltas: str) -> Mock:
+    """Build an async OpenAI client whose chat completions stream the given deltas."""
+    aclient = Mock()
+    aclient.chat.completions.create = AsyncMock(return_value=MockStream(*deltas))
+    return aclient
+
+async def collect(chunks) -> str:
+    """Join an async stream of text fragments."""
+    return "".join([chunk async for chunk in chunks])
+
+def semantic_session():
+    """Patch in a session state holding an empty semantic cache.
+
+    st.session_state does not persist values outside `streamlit run`.
+    """
+    return patch.object(st, "session_state", SimpleNamespace(sem_cache=new_semantic_cache()))
+
 def test_validate_file_size():
     """Test file size validation."""
     # Test file within size limit
@@ -43,42 +87,349 @@ def test_validate_file_type():
     assert not is_valid
     assert "Unsupported file type" in error
 
+def test_ext():
+    """Test extension parsing."""
+    assert _ext("Report.PDF") == "pdf"
+    assert _ext("archive.tar.gz") == "gz"
+    assert _ext("README") == ""
+
 @pytest.mark.asyncio
 async def test_generate_smart_summary():
     """Test summary generation."""
-    mock_client = Mock()
-    mock_response = Mock()
-    mock_response.choices = [Mock(message=Mock(content="Test summary"))]
-    mock_client.chat.completions.create.return_value = mock_response
+    aclient = mock_aclient("Test ", "summary")
 
-    summary = generate_smart_summary("Test content", mock_client)
+    summary = await collect(generate_smart_summary("Test content. " * 20, aclient))
     assert summary == "Test summary"
-    mock_client.chat.completions.create.assert_called_once()
+    aclient.chat.completions.create.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_generate_smart_summary_short_text():
+    """Test that very short texts skip the API."""
+    aclient = mock_aclient()
+
+    summary = await collect(generate_smart_summary("Just a note.", aclient))
+    assert summary == "Just a note."
+    aclient.chat.completions.create.assert_not_awaited()
+
+@pytest.mark.asyncio
+async def test_generate_smart_summary_cached():
+    """Test that repeated texts are served from the summary cache."""
+    aclient = mock_aclient("Cached summary")
+    # st.cache_resource does not memoize outside `streamlit run`
+    summary_cache = SummaryCache(max_entries=8, ttl=60)
+
+    with patch("app.get_summary_cache", return_value=summary_cache):
+        first = await collect(generate_smart_summary("Repeated content. " * 20, aclient))
+        second = await collect(generate_smart_summary("Repeated content. " * 20, aclient))
+    assert first == second == "Cached summary"
+    aclient.chat.completions.create.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_generate_smart_summary_semantic_cache():
+    """Test that near-duplicate texts reuse an earlier summary."""
+    aclient = mock_aclient("Original summary")
+    aclient.embeddings.create = AsyncMock(return_value=Mock(data=[Mock(embedding=[0.6, 0.8])]))
+
+    with semantic_session():
+        first = await collect(generate_smart_summary("Quarterly report, final. " * 20, aclient))
+        second = await collect(generate_smart_summary("Quarterly report, final (re-exported). " * 20, aclient))
+    assert first == second == "Original summary"
+    aclient.chat.completions.create.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_generate_smart_summary_semantic_cache_skips_long_texts(monkeypatch):
+    """Test that texts longer than one embedding covers bypass the semantic cache."""
+    monkeypatch.setattr(Config, "SEMANTIC_CACHE_MAX_CHARS", 300)
+    aclient = mock_aclient("Summary")
+    aclient.embeddings.create = AsyncMock(return_value=Mock(data=[Mock(embedding=[0.6, 0.8])]))
+
+    with semantic_session():
+        await collect(generate_smart_summary("Shared template. " * 20 + "Version one.", aclient))
+        await collect(generate_smart_summary("Shared template. " * 20 + "Version two.", aclient))
+    aclient.embeddings.create.assert_not_awaited()
+    assert aclient.chat.completions.create.await_count == 2
+
+def test_semantic_cache_is_keyed_by_model():
+    """Test that a summary from one model is not reused for another."""
+    vector = np.array([1, 0], dtype=np.float32)
+    with semantic_session():
+        _semantic_store(vector, "Old model summary", "sha", "gpt-4")
+        assert _semantic_lookup(vector, "gpt-4o-mini") is None
+        assert _semantic_lookup(vector, "gpt-4") == "Old model summary"
+
+def test_semantic_cache_evicts_oldest(monkeypatch):
+    """Test that a full semantic cache overwrites its oldest entry."""
+    monkeypatch.setattr(Config, "SEMANTIC_CACHE_SIZE", 2)
+    vectors = [np.array(v, dtype=np.float32) for v in ([1, 0, 0], [0, 1, 0], [0, 0, 1])]
+    with semantic_session():
+        for i, vector in enumerate(vectors):
+            _semantic_store(vector, f"Summary {i}", f"sha{i}", "model")
+
+        assert _semantic_lookup(vectors[0], "model") is None
+        assert _semantic_lookup(vectors[1], "model") == "Summary 1"
+        assert _semantic_lookup(vectors[2], "model") == "Summary 2"
+
+def test_semantic_cache_grows_lazily(monkeypatch):
+    """Test that the embedding buffer grows with use and stops at the cap."""
+    monkeypatch.setattr(Config, "SEMANTIC_CACHE_SIZE", 40)
+    vectors = np.eye(50, dtype=np.float32)
+    with semantic_session():
+        _semantic_store(vectors[0], "Summary 0", "sha0", "model")
+        assert st.session_state.sem_cache['embs'].shape == (16, 50)
+
+        for i in range(1, 50):
+            _semantic_store(vectors[i], f"Summary {i}", f"sha{i}", "model")
+        assert st.session_state.sem_cache['embs'].shape == (40, 50)
+        assert _semantic_lookup(vectors[20], "model") == "Summary 20"
+        assert _semantic_lookup(vectors[49], "model") == "Summary 49"
+        assert _semantic_lookup(vectors[5], "model") is None
+
+def test_summary_cache_evicts_and_expires(monkeypatch):
+    """Test LRU eviction and TTL expiry of the exact-match cache."""
+    cache = SummaryCache(max_entries=2, ttl=60)
+    cache.put(("m", "a"), "A")
+    cache.put(("m", "b"), "B")
+    assert cache.get(("m", "a")) == "A"  # "a" becomes most recently used
+    cache.put(("m", "c"), "C")
+    assert cache.get(("m", "b")) is None
+    assert cache.get(("m", "a")) == "A"
+
+    now = time.time()
+    monkeypatch.setattr("app.time.time", lambda: now + 61)
+    assert cache.get(("m", "a")) is None
+
+def test_split_into_chunks():
+    """Test paragraph-aware chunking."""
+    text = "\n\n".join(["a" * 40, "b" * 40, "c" * 40])
+    chunks = split_into_chunks(text, 90)
+    assert chunks == ["a" * 40 + "\n\n" + "b" * 40, "c" * 40]
+
+    # Oversize paragraphs are hard-split
+    assert split_into_chunks("x" * 25, 10) == ["x" * 10, "x" * 10, "x" * 5]
+
+@pytest.mark.asyncio
+async def test_summarize_chunks():
+    """Test concurrent section summaries keep document order."""
+    mock_aclient = Mock()
+    mock_aclient.chat.completions.create = AsyncMock(side_effect=[
+        Mock(choices=[Mock(message=Mock(content=f"Summary {i}"))]) for i in range(3)
+    ])
+
+    partials = await summarize_chunks(["one", "two", "three"], mock_aclient)
+    assert partials == ["Summary 0", "Summary 1", "Summary 2"]
+    assert mock_aclient.chat.completions.create.await_count == 3
+
+@pytest.mark.asyncio
+async def test_condense_text_reduces_until_it_fits(monkeypatch):
+    """Test that section summaries are reduced again while still too long."""
+    monkeypatch.setattr(Config, "MAX_SUMMARY_INPUT_TOKENS", 70)
+    monkeypatch.setattr(Config, "SUMMARY_CHUNK_CHARS", 100)
+    mock_aclient = Mock()
+    mock_aclient.chat.completions.create = AsyncMock(
+        return_value=Mock(choices=[Mock(message=Mock(content="s" * 40))])
+    )
+
+    text = "\n\n".join(["p" * 90] * 8)
+    condensed = await condense_text(text, mock_aclient)
+    assert len(condensed) // 4 <= 70
+    # 8 sections, then the joined partials re-chunked into 5 sections
+    assert mock_aclient.chat.completions.create.await_count == 13
+
+@pytest.mark.asyncio
+async def test_condense_text_stops_when_passes_do_not_help(monkeypatch):
+    """Test that condensing gives up instead of looping on text that won't shrink."""
+    monkeypatch.setattr(Config, "MAX_SUMMARY_INPUT_TOKENS", 70)
+    monkeypatch.setattr(Config, "SUMMARY_CHUNK_CHARS", 100)
+    mock_aclient = Mock()
+    mock_aclient.chat.completions.create = AsyncMock(
+        return_value=Mock(choices=[Mock(message=Mock(content="s" * 100))])
+    )
+    text = "\n\n".join(["p" * 90] * 8)
+
+    with pytest.raises(Exception, match="did not shrink"):
+        await condense_text(text, mock_aclient)
+    assert mock_aclient.chat.completions.create.await_count == 8
+
+    # Shrinking text that needs more passes than allowed also fails
+    monkeypatch.setattr(Config, "MAX_CONDENSE_PASSES", 1)
+    mock_aclient.chat.completions.create.return_value = Mock(choices=[Mock(message=Mock(content="s" * 40))])
+    with pytest.raises(Exception, match="after 1 condensing passes"):
+        await condense_text(text, mock_aclient)
+
+@pytest.mark.asyncio
+async def test_condense_text_leaves_short_text():
+    """Test that texts within the token budget are passed through."""
+    mock_aclient = Mock()
+    mock_aclient.chat.completions.create = AsyncMock()
+
+    assert await condense_text("Short text.", mock_aclient) == "Short text."
+    mock_aclient.chat.completions.create.assert_not_awaited()
+
+def test_count_tokens_estimates_without_tokenizer():
+    """Test the character-based estimate when no encoding can be loaded."""
+    with patch("app.get_encoding", return_value=None):
+        assert count_tokens("x" * 400, "gpt-4o-mini") == 100
 
 @pytest.mark.asyncio
 async def test_process_image():
     """Test image processing."""
-    # Create a temporary test image
-    test_image = Path("test_image.jpg")
-    test_image.write_bytes(b"fake image data")
+    aclient = mock_aclient("Test image ", "description")
+
+    description = await collect(process_image(b"fake image data", "jpg", aclient))
+
+    assert description == "Test image description"
+    aclient.chat.completions.create.assert_awaited_once()
+    call_kwargs = aclient.chat.completions.create.call_args.kwargs
+    assert call_kwargs["model"] == Config.VISION_MODEL
+    assert call_kwargs["max_tokens"] == Config.SUMMARY_MAX_TOKENS
+    image_part = call_kwargs["messages"][-1]["content"][1]
+    assert image_part["image_url"]["url"] == "data:image/jpeg;base64,ZmFrZSBpbWFnZSBkYXRh"
+
+def test_compress_image():
+    """Test that large images are downscaled to JPEG and small ones kept."""
+    img = Image.frombytes("RGB", (2048, 1536), os.urandom(2048 * 1536 * 3))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    original = buf.getvalue()
+
+    compressed, mime = compress_image(original, "image/png")
+    assert mime == "image/jpeg"
+    assert len(compressed) < len(original)
+    assert Image.open(io.BytesIO(compressed)).size == (1024, 768)
+
+    assert compress_image(b"tiny", "image/png") == (b"tiny", "image/png")
+
+def test_compress_image_applies_exif_orientation():
+    """Test that rotated photos keep their orientation after re-encoding."""
+    img = Image.frombytes("RGB", (2048, 1536), os.urandom(2048 * 1536 * 3))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=95, exif=exif)
+
+    compressed, _ = compress_image(buf.getvalue(), "image/jpeg")
+    assert Image.open(io.BytesIO(compressed)).size == (768, 1024)
+
+def test_compress_image_flattens_transparency_onto_white():
+    """Test that transparent areas become white rather than black."""
+    width, height = 2000, 2000
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    opaque = Image.frombytes("RGB", (width // 2, height), os.urandom(width // 2 * height * 3))
+    img.paste(opaque.convert("RGBA"), (width // 2, 0))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+
+    compressed, mime = compress_image(buf.getvalue(), "image/png")
+    assert mime == "image/jpeg"
+    result = Image.open(io.BytesIO(compressed)).convert("L")
+    assert min(result.crop((0, 0, 400, 1024)).getdata()) > 240
+
+def test_compress_image_keeps_smaller_original(monkeypatch):
+    """Test that an already compact image is not replaced by a larger re-encode."""
+    monkeypatch.setattr(Config, "IMAGE_COMPRESS_MIN_BYTES", 0)
+    img = Image.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=20)
+    original = buf.getvalue()
+
+    assert compress_image(original, "image/jpeg") == (original, "image/jpeg")
+
+@pytest.mark.asyncio
+async def test_extract_text_fast_decoders():
+    """Test that text formats bypass MarkItDown."""
+    with patch("app.get_markitdown") as mock_get_markitdown:
+        csv_text = await extract_text(b"name,qty\napple,3\n", "csv", Mock())
+        json_text = await extract_text(b'{"a": 1}', "json", Mock())
+
+    assert csv_text == "| name | qty |\n| --- | --- |\n| apple | 3 |"
+    assert json_text == '```json\n{\n  "a": 1\n}\n```'
+    mock_get_markitdown.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_extract_text_falls_back_to_markitdown():
+    """Test that unparseable fast-path files fall back to MarkItDown."""
+    mock_markitdown = Mock()
+    mock_markitdown.convert_stream.return_value = Mock(text_content="converted")
+
+    with patch("app.get_markitdown", return_value=mock_markitdown):
+        text = await extract_text(b"{not json", "json", Mock())
+
+    assert text == "converted"
+    mock_markitdown.convert_stream.assert_called_once()
+
+def test_get_markitdown_uses_vision_model():
+    """Test that the shared converter describes images with the vision model."""
+    mock_client = Mock()
+    with patch("app.MarkItDown") as mock_markitdown_cls:
+        get_markitdown(mock_client)
+
+    mock_markitdown_cls.assert_called_once_with(mlm_client=mock_client, mlm_model=Config.VISION_MODEL)
+
+def test_handlers_cover_file_types():
+    """Test that every supported extension has an upload handler."""
+    assert set(HANDLERS) == set(FILE_TYPES)
+    assert HANDLERS["png"] is handle_image
+    assert HANDLERS["pdf"] is handle_document
+    assert HANDLERS["csv"] is handle_document
+
+@pytest.mark.asyncio
+async def test_handle_document_uses_given_client():
+    """Test that documents are converted with the client passed to the handler."""
+    client = Mock()
+    with patch("app.extract_text", AsyncMock(return_value="  ")) as mock_extract:
+        record = await handle_document(b"data", "notes.pdf", "pdf", client, Mock(), Mock())
+
+    assert record is None
+    mock_extract.assert_awaited_once_with(b"data", "pdf", client)
+
+def test_save_to_history_dedupes_content(tmp_path, monkeypatch):
+    """Test that identical content is stored once and listed newest first."""
+    monkeypatch.setattr(Config, "HISTORY_DB", str(tmp_path / "history.db"))
+
+    save_to_history("owner-1", "a.pdf", "Summary A", "Content A")
+    save_to_history("owner-1", "b.pdf", "Summary B", "Content B")
+    save_to_history("owner-1", "a-copy.pdf", "Summary A", "Content A")
+
+    history = load_history("owner-1", 10)
+    assert [item['filename'] for item in history] == ["a.pdf", "b.pdf"]
+    assert history[0]['summary'] == "Summary A"
+
+def test_history_is_scoped_to_owner(tmp_path, monkeypatch):
+    """Test that one session never sees another session's history."""
+    monkeypatch.setattr(Config, "HISTORY_DB", str(tmp_path / "history.db"))
+
+    save_to_history("owner-1", "private.pdf", "Summary", "Shared content")
+    save_to_history("owner-2", "other.pdf", "Summary", "Shared content")
+
+    assert [item['filename'] for item in load_history("owner-1", 10)] == ["private.pdf"]
+    assert [item['filename'] for item in load_history("owner-2", 10)] == ["other.pdf"]
+    assert load_history("owner-3", 10) == []
+
+def test_history_is_pruned(tmp_path, monkeypatch):
+    """Test that old and surplus entries are deleted along with their content."""
+    monkeypatch.setattr(Config, "HISTORY_DB", str(tmp_path / "history.db"))
+    monkeypatch.setattr(Config, "HISTORY_MAX_ITEMS", 2)
 
-    try:
-        mock_client = Mock()
-        mock_result = Mock()
-        mock_result.text_content = "Test image description"
-        mock_markitdown = Mock()
-        mock_markitdown.convert.return_value = mock_result
+    for name in ("a", "b", "c"):
+        save_to_history("owner-1", f"{name}.pdf", "Summary", f"Content {name}")
+    assert [item['filename'] for item in load_history("owner-1", 10)] == ["c.pdf", "b.pdf"]
 
-        with patch("app.MarkItDown", return_value=mock_markitdown):
-            description, image_data = process_image(str(test_image), mock_client)
+    monkeypatch.setattr(Config, "HISTORY_MAX_AGE_DAYS", -1)
+    save_to_history("owner-2", "d.pdf", "Summary", "Content d")
+    assert load_history("owner-1", 10) == []
+    with sqlite3.connect(Config.HISTORY_DB) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM conversions").fetchone() == (0,)
 
-        assert description == "Test image description"
-        assert image_data == b"fake image data"
-        mock_markitdown.convert.assert_called_once()
+def test_history_owner_token_is_kept_in_url():
+    """Test that the owner token is issued once and reused from the URL."""
+    query_params = {}
+    with patch.object(st, "query_params", query_params):
+        token = history_owner_token()
+        assert query_params == {"history": token}
+        assert history_owner_token() == token
 
-    finally:
-        # Clean up
-        test_image.unlink()
+    with patch.object(st, "query_params", {"history": "not-a-token"}):
+        assert history_owner_token() != "not-a-token"
 
 def test_config_loading():
     """Test configuration loading."""
@@ -86,6 +437,8 @@ def test_config_loading():
     assert hasattr(Config, 'DEBUG')
     assert hasattr(Config, 'MAX_FILE_SIZE')
     assert hasattr(Config, 'MODEL_NAME')
+    assert hasattr(Config, 'VISION_MODEL')
 
     assert isinstance(Config.MAX_FILE_SIZE, int)
-    assert Config.MODEL_NAME == "gpt-4" 
\ No newline at end of file
+    assert Config.MODEL_NAME == os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+    assert Config.VISION_MODEL == os.getenv('OPENAI_VISION_MODEL', 'gpt-4o') 
\ No newline at end of file